@@ -1,9 +1,19 @@
+import io
+import base64
+import hashlib
+import math
 import os
+import asyncio
+import re
 import json
 import uuid
 import datetime
 import logging
+import threading
 import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters, ConversationHandler
 
@@ -11,10 +21,19 @@ from telegram.ext import Application, CommandHandler, CallbackQueryHandler, Mess
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 from google.auth.transport.requests import Request
 from google.auth.exceptions import RefreshError
 
+# Для S3-совместимого хранилища (необязательная зависимость)
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -31,6 +50,42 @@ TOKEN_FILE = os.path.join(BASE_DIR, 'token.json')
 # Настройки Google Drive API
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 
+# Настройки хранилища подписок
+STORAGE_BACKEND = 'drive'  # Бэкенд для новых подписок: 'drive', 'static' или 's3'
+
+# Локальная статическая директория (раздается через nginx)
+STATIC_DIR = os.path.join(BASE_DIR, 'static', 'subs')
+STATIC_BASE_URL = 'https://example.com/subs'  # Замените на ваш адрес
+
+# S3-совместимое хранилище (AWS S3, MinIO и т.д.)
+S3_ENDPOINT_URL = 'http://localhost:9000'  # None для AWS S3
+S3_REGION = 'us-east-1'
+S3_BUCKET = 'subscriptions'
+S3_ACCESS_KEY = 'minioadmin'  # Замените на ваш ключ
+S3_SECRET_KEY = 'minioadmin'  # Замените на ваш секрет
+S3_PUBLIC_URL = 'http://localhost:9000/subscriptions'  # Публичный адрес бакета
+
+# Параллелизм и повторные попытки для каждого бэкенда
+STORAGE_TUNING = {
+    'drive': {'max_workers': 2, 'max_retries': 5, 'retry_delay': 2.0},
+    'static': {'max_workers': 8, 'max_retries': 3, 'retry_delay': 0.2},
+    's3': {'max_workers': 16, 'max_retries': 4, 'retry_delay': 0.5},
+}
+
+# Распределение серверов между клиентами:
+# 'all' - все конфигурации в исходном порядке,
+# 'ordered' - все конфигурации в индивидуальном для клиента порядке,
+# 'subset' - только SUBSET_SIZE серверов, выбранных для клиента.
+# В режимах 'all' и 'ordered' новый сервер попадает в каждый файл, поэтому при добавлении
+# или удалении сервера перезагружаются все подписки. Только в режиме 'subset' меняются
+# файлы лишь тех клиентов, у которых этот сервер входит в выбранные (рекомендуется)
+DISTRIBUTION_MODE = 'all'
+SUBSET_SIZE = 3
+
+# Сверка подписок с Google Drive
+RECONCILE_INTERVAL = 3600  # Интервал автоматической сверки в секундах
+DRIVE_FILE_FIELDS = 'id,trashed,md5Checksum,permissionIds'
+
 # Стадии для ConversationHandler
 AWAITING_AUTH_CODE, AWAITING_CLIENT_NAME, AWAITING_CONFIGS = range(3)
 
@@ -38,6 +93,11 @@ AWAITING_AUTH_CODE, AWAITING_CLIENT_NAME, AWAITING_CONFIGS = range(3)
 ADMIN_USERS = [984155832]  # Замените на ваш Telegram ID
 
 # Функции для работы с базой данных
+# Блокировка для операций чтение-изменение-запись базы (сетевые запросы под ней не выполняются)
+DATABASE_LOCK = asyncio.Lock()
+# Блокировка, исключающая одновременный запуск нескольких сверок с Google Drive
+RECONCILE_LOCK = asyncio.Lock()
+
 def get_or_create_database():
     """Загрузка или создание базы данных подписок"""
     if os.path.exists(DATABASE_FILE):
@@ -58,39 +118,45 @@ def save_database(database):
         json.dump(database, f, indent=2)
 
 # Функции для Google Drive
-async def get_drive_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Получение аутентифицированного сервиса Google Drive с обработкой обновления токена"""
+def load_drive_credentials():
+    """Загрузка сохраненных учетных данных Google Drive с обновлением токена (без интерактивной авторизации)"""
     creds = None
     
     # Создаем папку для токена, если она не существует
     os.makedirs(os.path.dirname(TOKEN_FILE) or '.', exist_ok=True)
     
-    try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'r') as token:
-                try:
-                    creds = Credentials.from_authorized_user_info(json.load(token), SCOPES)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Invalid token file format: {e}")
-                    # Файл поврежден, удаляем его
-                    os.remove(TOKEN_FILE)
-                    creds = None
-        
-        # Проверяем, нужно ли обновить токен или получить новый
-        if creds and creds.expired and creds.refresh_token:
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, 'r') as token:
             try:
-                creds.refresh(Request())
+                creds = Credentials.from_authorized_user_info(json.load(token), SCOPES)
+            except json.JSONDecodeError as e:
+                logger.error(f"Invalid token file format: {e}")
+                # Файл поврежден, удаляем его
+                os.remove(TOKEN_FILE)
+                creds = None
+    
+    # Проверяем, нужно ли обновить токен или получить новый
+    if creds and creds.expired and creds.refresh_token:
+        try:
+            creds.refresh(Request())
+            
+            # Сохраняем обновленный токен
+            with open(TOKEN_FILE, 'w') as token:
+                token.write(creds.to_json())
                 
-                # Сохраняем обновленный токен
-                with open(TOKEN_FILE, 'w') as token:
-                    token.write(creds.to_json())
-                    
-                logger.info("Token refreshed successfully")
-            except RefreshError as e:
-                logger.error(f"Token refresh failed: {e}")
-                creds = None  # Сбрасываем учетные данные для создания новых
-                if os.path.exists(TOKEN_FILE):
-                    os.remove(TOKEN_FILE)
+            logger.info("Token refreshed successfully")
+        except RefreshError as e:
+            logger.error(f"Token refresh failed: {e}")
+            creds = None  # Сбрасываем учетные данные для создания новых
+            if os.path.exists(TOKEN_FILE):
+                os.remove(TOKEN_FILE)
+    
+    return creds
+
+async def get_drive_credentials(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получение учетных данных Google Drive; при необходимости запускает авторизацию и возвращает None"""
+    try:
+        creds = load_drive_credentials()
         
         # Если нет действительных учетных данных, запускаем авторизацию
         if not creds or not creds.valid:
@@ -108,11 +174,10 @@ async def get_drive_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return None
         
-        # Если у нас уже есть валидные учетные данные, создаем сервис
-        return build('drive', 'v3', credentials=creds, cache_discovery=False)
+        return creds
     
     except Exception as e:
-        logger.error(f"Error in get_drive_service: {e}")
+        logger.error(f"Error in get_drive_credentials: {e}")
         # Сообщаем пользователю об ошибке
         if hasattr(update, 'message'):
             await update.message.reply_text(f"Произошла ошибка при подключении к Google Drive: {str(e)}")
@@ -144,6 +209,15 @@ async def get_drive_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         return None
 
+async def get_drive_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Получение аутентифицированного сервиса Google Drive с обработкой обновления токена"""
+    creds = await get_drive_credentials(update, context)
+    if not creds:
+        return None
+    
+    # Если у нас уже есть валидные учетные данные, создаем сервис
+    return build('drive', 'v3', credentials=creds, cache_discovery=False)
+
 async def handle_auth_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кода авторизации Google с улучшенной обработкой ошибок"""
     auth_code = update.message.text.strip()
@@ -203,99 +277,527 @@ async def handle_auth_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return AWAITING_AUTH_CODE
 
-# Функции для управления подписками
-def create_subscription_file(service, client_name, configs):
-    """Создание файла подписки для клиента и возврат деталей файла"""
-    # Создаем уникальное имя файла для клиента
-    file_name = f"v2ray_sub_{client_name.replace(' ', '_').lower()}_{uuid.uuid4().hex[:8]}.txt"
-    file_path = os.path.join(BASE_DIR, file_name)
+# Бэкенды хранилища подписок
+class SubscriptionStorage(ABC):
+    """Базовый интерфейс хранилища файлов подписок с пакетной загрузкой и удалением"""
+    name = None
     
-    try:
-        # Записываем конфигурации в файл
-        with open(file_path, 'w') as f:
-            f.write('\n'.join(configs))
-        
-        # Загружаем в Google Drive
-        media = MediaFileUpload(file_path, mimetype='text/plain')
-        file_metadata = {
-            'name': file_name,
-            'parents': ['root']
-        }
+    def __init__(self, max_workers=4, max_retries=3, retry_delay=1.0):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+    
+    @abstractmethod
+    def put(self, key, content, file_id=None):
+        """Загрузка файла; возвращает (file_id, download_url). Если file_id задан, файл перезаписывается"""
+    
+    @abstractmethod
+    def delete(self, file_id):
+        """Удаление файла; отсутствующий файл не считается ошибкой"""
+    
+    def is_retryable(self, error):
+        """Можно ли повторить операцию после этой ошибки"""
+        return True
+    
+    def _retry(self, func, *args, **kwargs):
+        """Выполнение операции с повторными попытками и экспоненциальной задержкой"""
+        for attempt in range(self.max_retries):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries - 1 or not self.is_retryable(e):
+                    raise
+                delay = self.retry_delay * (2 ** attempt)
+                logger.warning(f"[{self.name}] Ошибка: {e}. Повтор через {delay:.1f} с")
+                time.sleep(delay)
+    
+    def _run_batch(self, func, items):
+        """Параллельное выполнение операции; возвращает результаты или исключения в исходном порядке"""
+        def run(item):
+            try:
+                return func(*item)
+            except Exception as e:
+                logger.error(f"[{self.name}] Операция не выполнена: {e}")
+                return e
+        
+        if self.max_workers <= 1 or len(items) <= 1:
+            return [run(item) for item in items]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(run, items))
+    
+    def put_many(self, items):
+        """Пакетная загрузка: items - список кортежей (key, content, file_id)"""
+        return self._run_batch(self.put, items)
+    
+    def delete_many(self, file_ids):
+        """Пакетное удаление файлов по их идентификаторам"""
+        return self._run_batch(self.delete, [(file_id,) for file_id in file_ids])
+
+class DriveStorage(SubscriptionStorage):
+    """Хранилище в Google Drive с публичными ссылками на скачивание"""
+    name = 'drive'
+    
+    def __init__(self, creds, **tuning):
+        super().__init__(**tuning)
+        self.creds = creds
+        # Клиент googleapiclient не потокобезопасен, поэтому у каждого потока свой сервис
+        self._local = threading.local()
+    
+    def _service(self):
+        if not hasattr(self._local, 'service'):
+            self._local.service = build('drive', 'v3', credentials=self.creds, cache_discovery=False)
+        return self._local.service
+    
+    def is_retryable(self, error):
+        if isinstance(error, HttpError):
+            if error.resp.status == 403:
+                # 403 означает и превышение лимитов, и постоянные ошибки (нет прав, нет места)
+                return self._error_reason(error) in ('rateLimitExceeded', 'userRateLimitExceeded')
+            return error.resp.status in (429, 500, 502, 503, 504)
+        return True
+    
+    @staticmethod
+    def _error_reason(error):
+        """Причина ошибки Google API (поле reason), если ее удалось извлечь"""
+        try:
+            return json.loads(error.content.decode('utf-8'))['error']['errors'][0]['reason']
+        except Exception:
+            return None
+    
+    def put(self, key, content, file_id=None):
+        service = self._service()
         
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
+        def media():
+            return MediaIoBaseUpload(io.BytesIO(content.encode('utf-8')), mimetype='text/plain')
         
-        # Устанавливаем публичный доступ
+        if file_id:
+            self._retry(lambda: service.files().update(fileId=file_id, media_body=media()).execute())
+        else:
+            file_metadata = {
+                'name': key,
+                'parents': ['root']
+            }
+            file = self._retry(lambda: service.files().create(
+                body=file_metadata,
+                media_body=media(),
+                fields='id'
+            ).execute())
+            file_id = file['id']
+            self.share(file_id)
+        
+        return file_id, f"https://drive.google.com/uc?id={file_id}&export=download"
+    
+    def delete(self, file_id):
+        service = self._service()
+        try:
+            self._retry(lambda: service.files().delete(fileId=file_id).execute())
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+    
+    def share(self, file_id):
+        """Установка публичного доступа к файлу по ссылке"""
         permission = {
             'type': 'anyone',
             'role': 'reader'
         }
-        service.permissions().create(
-            fileId=file['id'],
-            body=permission
-        ).execute()
-        
-        # Генерируем URL для скачивания
-        download_url = f"https://drive.google.com/uc?id={file['id']}&export=download"
-        
-        return {
-            "id": str(uuid.uuid4()),
-            "name": client_name,
-            "created_at": datetime.datetime.now().isoformat(),
-            "file_id": file['id'],
-            "download_url": download_url
-        }
-    finally:
-        # Гарантированно закрываем и удаляем файл в блоке finally
-        # Добавляем небольшую задержку и повторные попытки для Windows
-        retry_count = 3
-        for i in range(retry_count):
+        self._retry(lambda: self._service().permissions().create(fileId=file_id, body=permission).execute())
+    
+    def untrash(self, file_id):
+        """Восстановление файла из корзины"""
+        self._retry(lambda: self._service().files().update(fileId=file_id, body={'trashed': False}).execute())
+    
+    def get_file(self, file_id):
+        """Метаданные файла для сверки; None, если файл удален"""
+        try:
+            return self._retry(lambda: self._service().files().get(
+                fileId=file_id,
+                fields=DRIVE_FILE_FIELDS
+            ).execute())
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
+    
+    def start_page_token(self):
+        """Текущая позиция в ленте изменений Google Drive"""
+        return self._retry(lambda: self._service().changes().getStartPageToken().execute())['startPageToken']
+    
+    def list_changes(self, page_token):
+        """Изменения с позиции page_token; возвращает ({file_id: метаданные или None}, новая позиция)"""
+        changes = {}
+        while True:
+            response = self._retry(lambda: self._service().changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                includeRemoved=True,
+                pageSize=1000,
+                fields=f"nextPageToken,newStartPageToken,changes(fileId,removed,file({DRIVE_FILE_FIELDS}))"
+            ).execute())
+            
+            # Для каждого файла важно только последнее изменение
+            for change in response.get('changes', []):
+                if change.get('fileId'):
+                    changes[change['fileId']] = None if change.get('removed') else change.get('file')
+            
+            if 'newStartPageToken' in response:
+                return changes, response['newStartPageToken']
+            page_token = response['nextPageToken']
+
+class StaticDirStorage(SubscriptionStorage):
+    """Хранилище в локальной директории, которая раздается веб-сервером (например, nginx)"""
+    name = 'static'
+    
+    def __init__(self, directory, base_url, **tuning):
+        super().__init__(**tuning)
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        os.makedirs(self.directory, exist_ok=True)
+    
+    def is_retryable(self, error):
+        return isinstance(error, OSError) and not isinstance(error, (FileNotFoundError, PermissionError))
+    
+    def put(self, key, content, file_id=None):
+        file_id = file_id or key
+        path = os.path.join(self.directory, file_id)
+        
+        def write():
+            # Пишем во временный файл и атомарно подменяем, чтобы веб-сервер не отдал недописанный файл
+            temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
             try:
-                if os.path.exists(file_path):
-                    os.close(os.open(file_path, os.O_RDONLY))  # Попытка закрыть все дескрипторы файла
-                    os.remove(file_path)
-                break
-            except Exception as e:
-                if i < retry_count - 1:
-                    time.sleep(0.5)  # Небольшая задержка перед следующей попыткой
-                else:
-                    logger.warning(f"Не удалось удалить временный файл {file_path}: {e}")
+                with open(temp_path, 'w') as f:
+                    f.write(content)
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        
+        self._retry(write)
+        return file_id, f"{self.base_url}/{quote(file_id)}"
+    
+    def delete(self, file_id):
+        try:
+            self._retry(os.remove, os.path.join(self.directory, file_id))
+        except FileNotFoundError:
+            pass
+
+class S3Storage(SubscriptionStorage):
+    """Хранилище в S3-совместимом бакете (AWS S3, MinIO и т.д.)"""
+    name = 's3'
+    
+    def __init__(self, endpoint_url, region, bucket, access_key, secret_key, public_url, **tuning):
+        super().__init__(**tuning)
+        if boto3 is None:
+            raise RuntimeError("Для хранилища S3 необходимо установить пакет boto3")
+        self.bucket = bucket
+        self.public_url = public_url.rstrip('/')
+        # Клиент boto3 потокобезопасен; пул соединений подгоняем под число потоков,
+        # а повторы выполняем сами, чтобы настройки были едиными для всех бэкендов
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=BotoConfig(
+                max_pool_connections=max(self.max_workers, 10),
+                retries={'total_max_attempts': 1}
+            )
+        )
+    
+    def is_retryable(self, error):
+        if isinstance(error, ClientError):
+            status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+            return status >= 500 or status == 429 or error.response.get('Error', {}).get('Code') == 'SlowDown'
+        return True
+    
+    def put(self, key, content, file_id=None):
+        file_id = file_id or key
+        self._retry(
+            self.client.put_object,
+            Bucket=self.bucket,
+            Key=file_id,
+            Body=content.encode('utf-8'),
+            ContentType='text/plain; charset=utf-8'
+        )
+        return file_id, f"{self.public_url}/{quote(file_id)}"
+    
+    def delete(self, file_id):
+        self._retry(self.client.delete_object, Bucket=self.bucket, Key=file_id)
+
+async def get_storage(update: Update, context: ContextTypes.DEFAULT_TYPE, backend_name=None):
+    """Получение бэкенда хранилища; для Google Drive может запустить авторизацию и вернуть None"""
+    backend_name = backend_name or STORAGE_BACKEND
+    tuning = STORAGE_TUNING.get(backend_name, {})
+    
+    if backend_name == 'drive':
+        creds = await get_drive_credentials(update, context)
+        if not creds:
+            return None
+        return DriveStorage(creds, **tuning)
+    if backend_name == 'static':
+        return StaticDirStorage(STATIC_DIR, STATIC_BASE_URL, **tuning)
+    if backend_name == 's3':
+        return S3Storage(
+            S3_ENDPOINT_URL, S3_REGION, S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY, S3_PUBLIC_URL, **tuning
+        )
+    raise ValueError(f"Неизвестный бэкенд хранилища: {backend_name}")
+
+# Распределение серверов между клиентами
+def config_endpoint(config):
+    """Определение адреса сервера (host:port) конфигурации для группировки и весов"""
+    try:
+        scheme, _, rest = config.partition('://')
+        if scheme == 'vmess':
+            # vmess:// содержит JSON в base64
+            payload = rest.split('#')[0]
+            data = json.loads(base64.b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+            return f"{data['add']}:{data['port']}".lower()
+        netloc = urlsplit(config).netloc.rpartition('@')[2]
+        if netloc:
+            return netloc.lower()
+    except Exception:
+        pass
+    # Адрес определить не удалось: считаем конфигурацию отдельным сервером
+    return config
+
+def rank_endpoints(client_key, endpoints, weights=None):
+    """Упорядочивание серверов для клиента взвешенным rendezvous-хешированием.
+    
+    Каждый сервер получает для клиента оценку -w / ln(u), где u - хеш пары (клиент, сервер)
+    в интервале (0, 1). Добавление или удаление сервера не меняет взаимный порядок остальных
+    серверов, поэтому первые N серверов меняются только у клиентов, для которых он попадает в их число."""
+    weights = weights or {}
+    scores = {}
+    for endpoint in endpoints:
+        weight = float(weights.get(endpoint, 1))
+        if weight <= 0:
+            continue
+        digest = hashlib.sha256(f"{client_key}|{endpoint}".encode('utf-8')).digest()
+        # Берем старшие 52 бита: так u точно представимо во float и никогда не равно 1.0
+        u = ((int.from_bytes(digest[:8], 'big') >> 12) + 0.5) / 2 ** 52
+        scores[endpoint] = -weight / math.log(u)
+    return sorted(scores, key=lambda endpoint: (-scores[endpoint], endpoint))
+
+def build_subscription_configs(client_key, configs, weights=None):
+    """Список конфигураций для конкретного клиента в соответствии с DISTRIBUTION_MODE"""
+    if DISTRIBUTION_MODE == 'all':
+        return list(configs)
+    
+    # Группируем конфигурации по серверам, сохраняя исходный порядок внутри сервера
+    groups = {}
+    for config in configs:
+        groups.setdefault(config_endpoint(config), []).append(config)
+    
+    ranked = rank_endpoints(client_key, groups, weights)
+    if DISTRIBUTION_MODE == 'subset':
+        ranked = ranked[:SUBSET_SIZE]
+    return [config for endpoint in ranked for config in groups[endpoint]]
+
+def content_hash(content):
+    """MD5 содержимого файла подписки (совпадает с md5Checksum в Google Drive)"""
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+# Функции для управления подписками
+def subscription_file_name(client_name):
+    """Уникальное имя файла подписки для клиента (без символов, недопустимых в путях и ключах)"""
+    safe_name = re.sub(r'[^\w\-]', '_', client_name.replace(' ', '_').lower())
+    return f"v2ray_sub_{safe_name}_{uuid.uuid4().hex[:8]}.txt"
 
-def update_subscription(service, subscription, configs):
-    """Обновление существующей подписки новыми конфигурациями"""
-    # Создаем временный файл
-    temp_file = os.path.join(BASE_DIR, f"temp_{subscription['id']}.txt")
+def create_subscription_file(storage, client_name, configs, weights=None):
+    """Создание файла подписки для клиента и возврат деталей файла"""
+    subscription_id = str(uuid.uuid4())
+    
+    content = '\n'.join(build_subscription_configs(subscription_id, configs, weights))
+    file_id, download_url = storage.put(subscription_file_name(client_name), content)
+    
+    return {
+        "id": subscription_id,
+        "name": client_name,
+        "created_at": datetime.datetime.now().isoformat(),
+        "storage": storage.name,
+        "file_id": file_id,
+        "download_url": download_url,
+        "content_hash": content_hash(content)
+    }
+
+def update_subscriptions(storage, subscriptions, configs, weights=None):
+    """Пакетное обновление подписок одного хранилища; возвращает (обновлено, без изменений, ошибок).
+    
+    Файлы, содержимое которых не изменилось, повторно не загружаются."""
+    changed = []
+    for subscription in subscriptions:
+        content = '\n'.join(build_subscription_configs(subscription['id'], configs, weights))
+        if subscription.get('content_hash') != content_hash(content):
+            changed.append((subscription, content))
+    
+    items = [(s['file_id'], content, s['file_id']) for s, content in changed]
+    results = storage.put_many(items)
+    
+    updated = 0
+    for (subscription, content), result in zip(changed, results):
+        if not isinstance(result, Exception):
+            subscription['content_hash'] = content_hash(content)
+            updated += 1
+    return updated, len(subscriptions) - len(changed), len(changed) - updated
+
+# Сверка подписок с Google Drive
+def reconcile_drive(storage, subscriptions, configs, weights, page_token, pending_ids):
+    """Сверка файлов подписок в Google Drive с базой данных по ленте изменений.
+    
+    Проверяются только файлы, изменившиеся с позиции page_token, и подписки из pending_ids,
+    которые не удалось исправить в прошлый раз. Без page_token (первый запуск) один раз
+    проверяются все подписки в Google Drive. Возвращает словарь с обновлениями подписок,
+    новым списком отложенных подписок, новой позицией ленты и отчетом."""
+    drive_subscriptions = [s for s in subscriptions if s.get("storage", "drive") == "drive"]
+    by_file = {s["file_id"]: s for s in drive_subscriptions}
+    
+    # Метаданные из ленты изменений; для остальных проверяемых файлов запрашиваем их отдельно
+    if page_token:
+        changes, new_token = storage.list_changes(page_token)
+        known = {file_id: meta for file_id, meta in changes.items() if file_id in by_file}
+        suspects = list(known) + [
+            s["file_id"] for s in drive_subscriptions if s["id"] in pending_ids and s["file_id"] not in known
+        ]
+    else:
+        # Сначала запоминаем позицию, чтобы не пропустить изменения во время полной проверки
+        new_token = storage.start_page_token()
+        known = {}
+        suspects = list(by_file)
+    
+    updates = {}
+    pending = []
+    report = []
+    for file_id in suspects:
+        subscription = by_file[file_id]
+        content = '\n'.join(build_subscription_configs(subscription["id"], configs, weights))
+        try:
+            meta = known[file_id] if file_id in known else storage.get_file(file_id)
+            if meta is None:
+                # Файл удален безвозвратно: создаем заново, ссылка при этом меняется
+                new_file_id, download_url = storage.put(subscription_file_name(subscription["name"]), content)
+                updates[subscription["id"]] = {
+                    "file_id": new_file_id,
+                    "download_url": download_url,
+                    "content_hash": content_hash(content)
+                }
+                report.append(f"🔗 {subscription['name']}: файл был удален и создан заново, отправьте клиенту новую ссылку")
+                continue
+            
+            actions = []
+            if meta.get("trashed"):
+                storage.untrash(file_id)
+                actions.append("восстановлен из корзины")
+            if 'anyoneWithLink' not in meta.get("permissionIds", []):
+                storage.share(file_id)
+                actions.append("восстановлен публичный доступ")
+            if not subscription.get("content_hash"):
+                # Подписка создана до появления хешей: принимаем текущее содержимое за эталон
+                if meta.get("md5Checksum"):
+                    updates[subscription["id"]] = {"content_hash": meta["md5Checksum"]}
+            elif meta.get("md5Checksum") != subscription["content_hash"]:
+                storage.put(file_id, content, file_id)
+                updates[subscription["id"]] = {"content_hash": content_hash(content)}
+                actions.append("содержимое перезаписано")
+            if actions:
+                report.append(f"🛠 {subscription['name']}: {', '.join(actions)}")
+        except Exception as e:
+            logger.error(f"Ошибка сверки подписки {subscription['name']}: {e}")
+            pending.append(subscription["id"])
+            report.append(f"❌ {subscription['name']}: не удалось исправить ({e})")
+    
+    return {
+        "updates": updates,
+        "pending": pending,
+        "page_token": new_token,
+        "report": report
+    }
+
+async def run_reconciliation(storage):
+    """Запуск сверки в отдельном потоке и сохранение результатов; возвращает строки отчета"""
+    # Сверки не должны идти параллельно, иначе удаленный файл может быть пересоздан дважды.
+    # Сама база на время сетевых запросов не блокируется
+    async with RECONCILE_LOCK:
+        database = get_or_create_database()
+        result = await asyncio.to_thread(
+            reconcile_drive,
+            storage,
+            database["subscriptions"],
+            database["configs"],
+            database.get("weights"),
+            database.get("drive_changes_token"),
+            set(database.get("reconcile_pending", []))
+        )
+        
+        # Перечитываем базу: пока шла сверка, подписки могли быть изменены или удалены
+        async with DATABASE_LOCK:
+            database = get_or_create_database()
+            for subscription in database["subscriptions"]:
+                subscription.update(result["updates"].pop(subscription["id"], {}))
+            database["drive_changes_token"] = result["page_token"]
+            database["reconcile_pending"] = result["pending"]
+            save_database(database)
+        
+        # Файлы, пересозданные для подписок, удаленных во время сверки, больше не нужны
+        orphans = [fields["file_id"] for fields in result["updates"].values() if "file_id" in fields]
+        if orphans:
+            await asyncio.to_thread(storage.delete_many, orphans)
+    
+    return result["report"]
+
+async def reconcile_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ручная сверка подписок с Google Drive"""
+    # Проверка прав администратора
+    if update.effective_user.id not in ADMIN_USERS:
+        await update.callback_query.answer("У вас нет прав для выполнения этой операции")
+        return
+    
+    await update.callback_query.answer()
+    message = await update.callback_query.message.reply_text("⏳ Сверка подписок с Google Drive...")
     
     try:
-        # Записываем конфигурации в файл
-        with open(temp_file, 'w') as f:
-            f.write('\n'.join(configs))
+        database = get_or_create_database()
+        if not any(s.get("storage", "drive") == "drive" for s in database["subscriptions"]):
+            await message.edit_text("❌ Нет подписок в Google Drive.")
+            return
         
-        # Загружаем в Google Drive (обновляем)
-        media = MediaFileUpload(temp_file, mimetype='text/plain')
-        updated_file = service.files().update(
-            fileId=subscription['file_id'],
-            media_body=media
-        ).execute()
+        storage = await get_storage(update, context, "drive")
+        if not storage:
+            return AWAITING_AUTH_CODE
         
-        return True
-    finally:
-        # Гарантированно закрываем и удаляем файл в блоке finally
-        retry_count = 3
-        for i in range(retry_count):
-            try:
-                if os.path.exists(temp_file):
-                    os.close(os.open(temp_file, os.O_RDONLY))  # Попытка закрыть все дескрипторы файла
-                    os.remove(temp_file)
-                break
-            except Exception as e:
-                if i < retry_count - 1:
-                    time.sleep(0.5)  # Небольшая задержка перед следующей попыткой
-                else:
-                    logger.warning(f"Не удалось удалить временный файл {temp_file}: {e}")
+        report = await run_reconciliation(storage)
+        if report:
+            # Telegram ограничивает длину сообщения 4096 символами
+            await message.edit_text(("🩺 Результаты сверки:\n\n" + '\n'.join(report))[:4000])
+        else:
+            await message.edit_text("✅ Расхождений не найдено!")
+        
+    except Exception as e:
+        logger.error(f"Ошибка при сверке подписок: {e}")
+        await message.edit_text(f"❌ Ошибка при сверке подписок: {str(e)}")
+
+async def reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая сверка подписок с Google Drive; об исправлениях сообщает администраторам"""
+    try:
+        database = get_or_create_database()
+        if not any(s.get("storage", "drive") == "drive" for s in database["subscriptions"]):
+            return
+        
+        creds = await asyncio.to_thread(load_drive_credentials)
+        if not creds or not creds.valid:
+            logger.warning("Сверка пропущена: нет действительного токена Google Drive")
+            return
+        
+        report = await run_reconciliation(DriveStorage(creds, **STORAGE_TUNING.get('drive', {})))
+        if report:
+            for admin_id in ADMIN_USERS:
+                await context.bot.send_message(
+                    admin_id,
+                    ("🩺 Автоматическая сверка подписок:\n\n" + '\n'.join(report))[:4000]
+                )
+    except Exception as e:
+        logger.error(f"Ошибка автоматической сверки подписок: {e}")
 
 async def update_all_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обновление всех подписок текущими конфигурациями"""
@@ -308,11 +810,6 @@ async def update_all_subscriptions(update: Update, context: ContextTypes.DEFAULT
     message = await update.callback_query.message.reply_text("⏳ Обновление всех подписок...")
     
     try:
-        # Получаем сервис Google Drive
-        service = await get_drive_service(update, context)
-        if not service:
-            return AWAITING_AUTH_CODE
-        
         # Получаем данные
         database = get_or_create_database()
         configs = database["configs"]
@@ -325,13 +822,49 @@ async def update_all_subscriptions(update: Update, context: ContextTypes.DEFAULT
             await message.edit_text("❌ Нет подписок для обновления.")
             return
         
-        # Обновляем каждую подписку
-        update_count = 0
+        # Группируем подписки по хранилищам, чтобы обновлять их пакетами
+        groups = {}
         for subscription in database["subscriptions"]:
-            update_subscription(service, subscription, configs)
-            update_count += 1
+            groups.setdefault(subscription.get("storage", "drive"), []).append(subscription)
         
-        await message.edit_text(f"✅ Успешно обновлено {update_count} подписок!")
+        # Обновляем подписки в каждом хранилище; загрузка идет без блокировки базы
+        update_count = skipped_count = failed_count = 0
+        weights = database.get("weights", {})
+        try:
+            for backend_name, subscriptions in groups.items():
+                storage = await get_storage(update, context, backend_name)
+                if not storage:
+                    return AWAITING_AUTH_CODE
+                updated, skipped, failed = await asyncio.to_thread(
+                    update_subscriptions, storage, subscriptions, configs, weights
+                )
+                update_count += updated
+                skipped_count += skipped
+                failed_count += failed
+        finally:
+            # Сохраняем хеши содержимого, чтобы не загружать неизменившиеся файлы повторно.
+            # Базу перечитываем и переносим только хеши: пока шла загрузка, ее могли изменить
+            uploaded = {
+                s["id"]: (s["file_id"], s["content_hash"])
+                for s in database["subscriptions"] if s.get("content_hash")
+            }
+            async with DATABASE_LOCK:
+                database = get_or_create_database()
+                for subscription in database["subscriptions"]:
+                    file_id, hash_value = uploaded.get(subscription["id"], (None, None))
+                    if file_id == subscription["file_id"]:
+                        subscription["content_hash"] = hash_value
+                save_database(database)
+        
+        if failed_count:
+            await message.edit_text(
+                f"⚠️ Обновлено {update_count} подписок, без изменений {skipped_count}, "
+                f"не удалось обновить {failed_count}."
+            )
+        else:
+            await message.edit_text(
+                f"✅ Успешно обновлено {update_count} подписок! Без изменений: {skipped_count}."
+            )
         
     except Exception as e:
         logger.error(f"Ошибка при обновлении подписок: {e}")
@@ -345,8 +878,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ У вас нет прав доступа к этому боту.")
         return
     
-    # Проверяем, есть ли уже токен для Google Drive
-    if not os.path.exists(TOKEN_FILE):
+    # Проверяем, есть ли уже токен для Google Drive (нужен и для старых подписок в Drive,
+    # даже если новые создаются в другом хранилище)
+    database = get_or_create_database()
+    uses_drive = STORAGE_BACKEND == 'drive' or any(
+        s.get("storage", "drive") == "drive" for s in database["subscriptions"]
+    )
+    if uses_drive and not os.path.exists(TOKEN_FILE):
         service = await get_drive_service(update, context)
         if not service:
             return AWAITING_AUTH_CODE
@@ -364,7 +902,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📝 Управление конфигурациями", callback_data="manage_configs")],
         [InlineKeyboardButton("🔄 Управление подписками", callback_data="manage_subscriptions")],
         [InlineKeyboardButton("➕ Создать подписку", callback_data="create_subscription")],
-        [InlineKeyboardButton("🔄 Обновить все подписки", callback_data="update_all")]
+        [InlineKeyboardButton("🔄 Обновить все подписки", callback_data="update_all")],
+        [InlineKeyboardButton("🩺 Проверить подписки", callback_data="reconcile")]
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -457,9 +996,10 @@ async def save_configs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     configs = [line.strip() for line in configs_text.split('\n') if line.strip()]
     
     # Обновляем базу данных
-    database = get_or_create_database()
-    database["configs"] = configs
-    save_database(database)
+    async with DATABASE_LOCK:
+        database = get_or_create_database()
+        database["configs"] = configs
+        save_database(database)
     
     await update.message.reply_text(f"✅ Успешно сохранено {len(configs)} конфигураций!")
     
@@ -467,6 +1007,76 @@ async def save_configs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_main_menu(update, context)
     return ConversationHandler.END
 
+async def set_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /weight: просмотр и изменение весов серверов"""
+    # Проверка прав администратора
+    if update.effective_user.id not in ADMIN_USERS:
+        await update.message.reply_text("⚠️ У вас нет прав доступа к этому боту.")
+        return
+    
+    database = get_or_create_database()
+    weights = database.get("weights", {})
+    
+    # Конфигурации без распознанного адреса не показываем: в них могут быть учетные данные
+    configs = set(database["configs"])
+    all_endpoints = {config_endpoint(config) for config in configs}
+    endpoints = sorted(endpoint for endpoint in all_endpoints if endpoint not in configs)
+    unparsed_count = len(all_endpoints) - len(endpoints)
+    
+    if not context.args:
+        message_text = f"⚖️ *Веса серверов* (режим: `{DISTRIBUTION_MODE}`)\n\n"
+        footer = "\nИзменить вес: `/weight host:port вес` (0 - исключить сервер)"
+        if unparsed_count:
+            footer = f"\nКонфигураций без распознанного адреса: {unparsed_count} (вес 1)" + footer
+        for i, endpoint in enumerate(endpoints):
+            line = f"• `{endpoint.replace('`', '')}`: {weights.get(endpoint, 1):g}\n"
+            # Telegram ограничивает длину сообщения 4096 символами
+            if len(message_text) + len(line) + len(footer) > 3950:
+                message_text += f"...и еще {len(endpoints) - i} серверов\n"
+                break
+            message_text += line
+        await update.message.reply_text(message_text + footer, parse_mode="Markdown")
+        return
+    
+    try:
+        endpoint = context.args[0].lower()
+        weight = float(context.args[1])
+        if not math.isfinite(weight) or weight < 0:
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text("⚠️ Формат: /weight host:port вес (неотрицательное число)")
+        return
+    
+    if endpoint not in endpoints:
+        await update.message.reply_text(
+            f"⚠️ Сервер {endpoint} не найден среди конфигураций. Список серверов: /weight"
+        )
+        return
+    
+    async with DATABASE_LOCK:
+        database = get_or_create_database()
+        weights = dict(database.get("weights", {}))
+        if weight == 1:
+            weights.pop(endpoint, None)
+        else:
+            weights[endpoint] = weight
+        
+        # Без серверов с положительным весом все подписки оказались бы пустыми
+        all_endpoints = {config_endpoint(config) for config in database["configs"]}
+        has_servers = any(weights.get(e, 1) > 0 for e in all_endpoints)
+        if has_servers:
+            database["weights"] = weights
+            save_database(database)
+    
+    if not has_servers:
+        await update.message.reply_text("⚠️ Нельзя исключить все серверы: хотя бы у одного вес должен быть больше 0.")
+        return
+    
+    await update.message.reply_text(
+        f"✅ Вес сервера {endpoint} установлен: {weight:g}\n"
+        "Нажмите «Обновить все подписки», чтобы применить изменения."
+    )
+
 async def manage_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Управление подписками клиентов"""
     await update.callback_query.answer()
@@ -549,21 +1159,25 @@ async def create_subscription_action(update: Update, context: ContextTypes.DEFAU
     await update.message.reply_text(f"⏳ Создание подписки для {client_name}...")
     
     try:
-        # Получаем сервис Google Drive
-        service = await get_drive_service(update, context)
-        if not service:
+        # Получаем хранилище подписок
+        storage = await get_storage(update, context)
+        if not storage:
             return AWAITING_AUTH_CODE
         
         # Получаем данные
         database = get_or_create_database()
         configs = database["configs"]
         
-        # Создаем подписку
-        subscription = create_subscription_file(service, client_name, configs)
+        # Создаем подписку (загрузка идет без блокировки базы, чтобы не задерживать другие операции)
+        subscription = await asyncio.to_thread(
+            create_subscription_file, storage, client_name, configs, database.get("weights")
+        )
         
         # Добавляем в базу данных
-        database["subscriptions"].append(subscription)
-        save_database(database)
+        async with DATABASE_LOCK:
+            database = get_or_create_database()
+            database["subscriptions"].append(subscription)
+            save_database(database)
         
         # Отправляем результат
         message_text = (
@@ -609,17 +1223,23 @@ async def delete_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE
             await message.edit_text("❌ Подписка не найдена")
             return
         
-        # Получаем сервис Google Drive
-        service = await get_drive_service(update, context)
-        if not service:
+        # Получаем хранилище, в котором находится подписка
+        storage = await get_storage(update, context, subscription.get("storage", "drive"))
+        if not storage:
             return AWAITING_AUTH_CODE
         
-        # Удаляем из Google Drive
-        service.files().delete(fileId=subscription["file_id"]).execute()
+        # Удаляем файл из хранилища
+        await asyncio.to_thread(storage.delete, subscription["file_id"])
         
-        # Удаляем из базы данных
-        database["subscriptions"] = [s for s in database["subscriptions"] if s["id"] != subscription_id]
-        save_database(database)
+        # Удаляем из базы данных, перечитав ее: файл мог быть пересоздан сверкой
+        async with DATABASE_LOCK:
+            database = get_or_create_database()
+            current = next((s for s in database["subscriptions"] if s["id"] == subscription_id), None)
+            database["subscriptions"] = [s for s in database["subscriptions"] if s["id"] != subscription_id]
+            save_database(database)
+        
+        if current and current["file_id"] != subscription["file_id"]:
+            await asyncio.to_thread(storage.delete, current["file_id"])
         
         await message.edit_text(f"✅ Подписка для {subscription['name']} успешно удалена!")
         
@@ -651,6 +1271,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await create_subscription_prompt(update, context)
     elif callback_data == "update_all":
         await update_all_subscriptions(update, context)
+    elif callback_data == "reconcile":
+        await reconcile_subscriptions(update, context)
     elif callback_data == "edit_configs":
         return await edit_configs(update, context)
     elif callback_data.startswith("delete_"):
@@ -699,8 +1321,15 @@ def main():
     application.add_handler(subscription_conv_handler)
     application.add_handler(configs_conv_handler)
     application.add_handler(CommandHandler("menu", start))
+    application.add_handler(CommandHandler("weight", set_weight))
     application.add_handler(CallbackQueryHandler(handle_callback))
     
+    # Периодическая сверка подписок с Google Drive (требуется python-telegram-bot[job-queue])
+    if application.job_queue:
+        application.job_queue.run_repeating(reconcile_job, interval=RECONCILE_INTERVAL, first=60)
+    else:
+        logger.warning("JobQueue недоступна, автоматическая сверка подписок отключена")
+    
     # Запускаем бота
     application.run_polling()
 